@@ -12,6 +12,7 @@ from functions import (
     get_topology_resource_data,
     get_prp_mapping_data,
     get_ospool_aps,
+    prefetch_topology,
     OSPOOL_COLLECTORS,
     NON_OSPOOL_RESOURCES,
     send_email
@@ -31,6 +32,7 @@ OSPOOL_RAW_DATA_INDEX = "osg_schedd_write"
 
 OSPOOL_APS = get_ospool_aps()
 
+prefetch_topology()
 RESOURCE_MAP = get_topology_resource_data()
 PROJECT_MAP = get_topology_project_data()
 OSG_ID_MAP = get_prp_mapping_data()
@@ -16,7 +16,7 @@ QUERY_ID = "OSG-schedd-job-history"
 REPORT_PERIOD = "daily"
 
 
-def get_query(query_id, report_period, days, now):
+def get_query(query_id, report_period, days, start_date, end_date):
     query = {
         "size": days+1,
         "query": {
@@ -24,8 +24,8 @@ def get_query(query_id, report_period, days, now):
                 "filter": [
                     {"range": {
                         "date": {
-                            "gte": (now - timedelta(days=days)).strftime("%Y-%m-%d"),
-                            "lt": now.strftime("%Y-%m-%d"),
+                            "gte": start_date,
+                            "lt": end_date,
                         }
                     }},
                     {"term": {
@@ -187,13 +187,16 @@ def main():
     args = parse_args()
     days = args.days
     to = args.to or TO
-    xlsx_file = Path() / "daily_totals_sheets" / now.strftime(f"%Y-%m-%d_OSPool_{days}day_Summary.xlsx")
+    start_date = (now - timedelta(days=days)).strftime("%Y-%m-%d")
+    end_date = now.strftime("%Y-%m-%d")
+    last_date = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+    xlsx_file = Path() / "daily_totals_sheets" / f"{end_date}_OSPool_{days}day_Summary.xlsx"
     es = elasticsearch.Elasticsearch()
-    query = get_query(QUERY_ID, REPORT_PERIOD, days, now)
+    query = get_query(QUERY_ID, REPORT_PERIOD, days, start_date, end_date)
     docs = do_query(es, ES_INDEX_NAME, query)
     docs.sort(key = lambda x: datetime.strptime(x["date"], "%Y-%m-%d"), reverse=True)
     html = write_xlsx_html(docs, xlsx_file)
-    subject = f"{days}-day OSPool Totals Summary from {(now - timedelta(days=days)).strftime('%Y-%m-%d')} to {(now - timedelta(days=1)).strftime('%Y-%m-%d')}"
+    subject = f"{days}-day OSPool Totals Summary from {start_date} to {last_date}"
     send_email(from_addr="accounting@chtc.wisc.edu", to_addrs=to, replyto_addr="ospool-reports@path-cc.io", subject=subject, html=html, attachments=[xlsx_file])
 
 
@@ -1,3 +1,5 @@
+import time
+import socket
 import smtplib
 import dns.resolver
 from email.mime.multipart import MIMEMultipart
@@ -7,37 +9,44 @@ from email import encoders
 from pathlib import Path
 
 
+SMTP_TIMEOUT = 30
+
+
 def _smtp_mail(msg, recipient, smtp_server=None, smtp_username=None, smtp_password=None):
     sent = False
     result = None
     tries = 0
     sleeptime = 0
+    body = msg.as_bytes()
     while tries < 3 and sleeptime < 600:
         try:
             if smtp_username is None:
-                smtp = smtplib.SMTP(smtp_server)
+                smtp = smtplib.SMTP(smtp_server, timeout=SMTP_TIMEOUT)
             else:
-                smtp = smtplib.SMTP_SSL(smtp_server)
+                smtp = smtplib.SMTP_SSL(smtp_server, timeout=SMTP_TIMEOUT)
                 smtp.login(smtp_username, smtp_password)
+        except (socket.gaierror, ConnectionRefusedError):
+            # Host does not resolve or is not listening, retrying will not help
+            print(f"Could not connect to {smtp_server}, not retrying")
+            break
         except Exception:
             print(f"Could not connect to {smtp_server}")
-            continue
-
-        try:
-            result = smtp.sendmail(msg["From"], recipient, msg.as_string())
-            if len(result) > 0:
-                print(f"Could not send email to {recipient} using {smtp_server}:\n{result}")
-            else:
-                sent = True
-        except Exception:
-            print(f"Could not send to {recipient} using {smtp_server}")
-        finally:
+        else:
             try:
-                smtp.quit()
-            except smtplib.SMTPServerDisconnected:
-                pass
-        if sent:
-            break
+                result = smtp.sendmail(msg["From"], recipient, body)
+                if len(result) > 0:
+                    print(f"Could not send email to {recipient} using {smtp_server}:\n{result}")
+                else:
+                    sent = True
+            except Exception:
+                print(f"Could not send to {recipient} using {smtp_server}")
+            finally:
+                try:
+                    smtp.quit()
+                except smtplib.SMTPServerDisconnected:
+                    pass
+            if sent:
+                break
 
         sleeptime = int(min(30 * 1.5**tries, 600))
         print(f"Sleeping for {sleeptime} seconds before retrying servers")
@@ -90,6 +99,7 @@ def send_email(from_addr, to_addrs, subject="", replyto_addr=None, cc_addrs=[],
         _smtp_mail(msg, recipient, smtp_server, smtp_username, smtp_password)
 
     else:
+        body = msg.as_bytes()
         for recipient in to_addrs + cc_addrs + bcc_addrs:
             domain = recipient.split("@")[1]
             sent = False
@@ -97,8 +107,8 @@ def send_email(from_addr, to_addrs, subject="", replyto_addr=None, cc_addrs=[],
             for mx in dns.resolver.query(domain, "MX"):
                 mailserver = str(mx).split()[1][:-1]
                 try:
-                    smtp = smtplib.SMTP(mailserver)
-                    result = smtp.sendmail(from_addr, recipient, msg.as_string())
+                    smtp = smtplib.SMTP(mailserver, timeout=SMTP_TIMEOUT)
+                    result = smtp.sendmail(from_addr, recipient, body)
                     smtp.quit
                 except Exception:
                     if result is not None:
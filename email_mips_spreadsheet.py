@@ -17,7 +17,7 @@ DAYS = 30
 ES_INDEX_NAME = "mips_report"
 POOL_NAME = "OSPool"
 
-def get_query(pool_name, days, now):
+def get_query(pool_name, days, start_time, end_time):
     query = {
         "size": days*4,
         "query": {
@@ -25,8 +25,8 @@ def get_query(pool_name, days, now):
                 "filter": [
                     {"range": {
                         "date": {
-                            "gte": (now - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S"),
-                            "lt": now.strftime("%Y-%m-%d %H:%M:%S"),
+                            "gte": start_time,
+                            "lt": end_time,
                         }
                     }},
                     {"term": {
@@ -180,13 +180,16 @@ def main():
     args = parse_args()
     days = args.days
     to = args.to or TO
-    xlsx_file = Path() / "mips_sheets" / now.strftime(f"%Y-%m-%d_{days}day_MIPS_Report.xlsx")
+    start_time = (now - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    end_time = now.strftime("%Y-%m-%d %H:%M:%S")
+    last_date = (now - timedelta(days=1)).strftime("%Y-%m-%d")
+    xlsx_file = Path() / "mips_sheets" / f"{end_time[:10]}_{days}day_MIPS_Report.xlsx"
     es = elasticsearch.Elasticsearch()
-    query = get_query(POOL_NAME, days, now)
+    query = get_query(POOL_NAME, days, start_time, end_time)
     docs = do_query(es, ES_INDEX_NAME, query)
     docs.sort(key = lambda x: datetime.strptime(x["date"], "%Y-%m-%d %H:%M:%S"), reverse=True)
     html = write_xlsx_html(docs, xlsx_file)
-    subject = f"{days}-day {POOL_NAME} MIPS Summary from {(now - timedelta(days=days)).strftime('%Y-%m-%d')} to {(now - timedelta(days=1)).strftime('%Y-%m-%d')}"
+    subject = f"{days}-day {POOL_NAME} MIPS Summary from {start_time[:10]} to {last_date}"
     send_email(from_addr=args.from_addr, to_addrs=to, replyto_addr="ospool-reports@path-cc.io", subject=subject, html=html, attachments=[xlsx_file],
                 smtp_server=args.smtp_server, smtp_username=args.smtp_username, smtp_password_file=args.smtp_password_file)
 
@@ -1,25 +1,37 @@
-import re
+import base64
 import sys
 import time
-import json
-import pickle
+import socket
 import smtplib
-import xml.etree.ElementTree as ET
-from urllib.request import urlopen
-from urllib.error import HTTPError
-from email import encoders
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from email.mime.multipart import MIMEMultipart
 from email.mime.text  import MIMEText
 from email.mime.base import MIMEBase
 from email.utils import formatdate
 from pathlib import Path
+from urllib.error import HTTPError
 
 import htcondor
-from dns.resolver import query as dns_query
+import dns.resolver
+
+from topology_cache import (
+    load_cache,
+    dump_cache,
+    urlopen_with_retry,
+    response_validators,
+    iter_resource_groups,
+    ET,
+)
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 
 TOPOLOGY_PROJECT_DATA_URL = "https://topology.opensciencegrid.org/miscproject/xml"
-TOPOLOGY_RESOURCE_DATA_URL = "https://topology.opensciencegrid.org/rgsummary/xml"
 INSTITUTION_IDS_DATA_URL = "https://topology-institutions.osg-htc.org/api/institution_ids"
 
 OSPOOL_APS = {
@@ -73,30 +85,26 @@ NON_OSPOOL_RESOURCES = {
     "UIUC-ICC-SPT",
     "TACC-Frontera-CE2",
 }
+SMTP_TIMEOUT = 30
+
+# Shared resolver so MX answers are cached (honoring their TTLs) and lookups fail fast
+DNS_RESOLVER = dns.resolver.Resolver()
+DNS_RESOLVER.cache = dns.resolver.LRUCache(max_size=1000)
+DNS_RESOLVER.timeout = 2.0
+DNS_RESOLVER.lifetime = 5.0
 
+# Only match Schedd ads that report to an OSPool collector
+OSPOOL_COLLECTORS_CONSTRAINT = " || ".join(
+    f'stringListMember("{collector}", CollectorHost)' for collector in sorted(OSPOOL_COLLECTORS)
+)
 
+
+@lru_cache(maxsize=4)
 def get_topology_project_data(cache_file=Path("./topology_project_data.pickle")) -> dict:
-    if cache_file.exists() and cache_file.stat().st_mtime > time.time() - 23*3600:
-        try:
-            projects_map = pickle.load(cache_file.open("rb"))
-        except Exception:
-            pass
-        else:
-            return projects_map
-    tries = 0
-    max_tries = 5
-    while tries < max_tries:
-        try:
-            with urlopen(TOPOLOGY_PROJECT_DATA_URL) as xml:
-                xmltree = ET.parse(xml)
-        except HTTPError:
-            time.sleep(2**tries)
-            tries += 1
-            if tries == max_tries:
-                raise
-        else:
-            break
-    projects = xmltree.getroot()
+    cache, fresh = load_cache(cache_file, 23*3600)
+    if fresh:
+        return cache["data"]
+    validators = cache["validators"] if cache is not None else {}
     projects_map = {
         "Unknown": {
             "name": "Unknown",
@@ -105,159 +113,176 @@ def get_topology_project_data(cache_file=Path("./topology_project_data.pickle"))
             "field_of_science": "Unknown",
         }
     }
-
-    for project in projects:
-        project_map = {}
-        project_map["name"] = project.find("Name").text
-        project_map["pi"] = project.find("PIName").text
-        project_map["pi_institution"] = project.find("Organization").text
-        project_map["field_of_science"] = project.find("FieldOfScience").text
-        project_map["id"] = project.find("ID").text
-        project_map["pi_institution_id"] = project.find("InstitutionID").text
-        project_map["field_of_science_id"] = project.find("FieldOfScienceID").text
-        projects_map[project_map["name"].lower()] = project_map.copy()
-
-    pickle.dump(projects_map, cache_file.open("wb"))
+    try:
+        with urlopen_with_retry(TOPOLOGY_PROJECT_DATA_URL, validators) as xml:
+            validators = response_validators(xml)
+            # Stream the document and drop each <Project> once it has been read
+            for _, project in ET.iterparse(xml, events=("end",)):
+                if project.tag != "Project":
+                    continue
+                fields = {child.tag: child.text for child in project}
+                project_map = {}
+                project_map["name"] = fields["Name"]
+                project_map["pi"] = fields["PIName"]
+                project_map["pi_institution"] = fields["Organization"]
+                project_map["field_of_science"] = fields["FieldOfScience"]
+                project_map["id"] = fields["ID"]
+                project_map["pi_institution_id"] = fields["InstitutionID"]
+                project_map["field_of_science_id"] = fields["FieldOfScienceID"]
+                projects_map[project_map["name"].lower()] = project_map
+                project.clear()
+    except HTTPError as err:
+        if err.code == 304 and cache is not None:
+            # Unchanged upstream, keep using the cached data for another day
+            cache_file.touch()
+            return cache["data"]
+        raise
+
+    dump_cache(cache_file, projects_map, validators)
     return projects_map
 
 
+@lru_cache(maxsize=4)
 def get_topology_resource_data(cache_file=Path("./topology_resource_data.pickle")) -> dict:
-    if cache_file.exists() and cache_file.stat().st_mtime > time.time() - 23*3600:
-        try:
-            resources_map = pickle.load(cache_file.open("rb"))
-        except Exception:
-            pass
-        else:
-            return resources_map
-    tries = 0
-    max_tries = 5
-    while tries < max_tries:
-        try:
-            with urlopen(TOPOLOGY_RESOURCE_DATA_URL) as xml:
-                xmltree = ET.parse(xml)
-        except HTTPError:
-            time.sleep(2**tries)
-            tries += 1
-            if tries == max_tries:
-                raise
-        else:
-            break
-    resource_groups = xmltree.getroot()
+    cache, fresh = load_cache(cache_file, 23*3600)
+    if fresh:
+        return cache["data"]
     resources_map = {
         "Unknown": {
             "name": "Unknown",
             "institution": "Unknown",
         }
     }
-
-    for resource_group in resource_groups:
-        resource_institution = resource_group.find("Facility").find("Name").text
-        resource_institution_id = resource_group.find("Facility").find("ID").text
-        resource_institution_osg_id = resource_group.find("Facility").find("InstitutionID").text
-
+    for resource_group in iter_resource_groups():
+        facility = resource_group.find("Facility")
+        resource_institution = facility.find("Name").text
+        resource_institution_id = facility.find("ID").text
+        resource_institution_osg_id = facility.find("InstitutionID").text
+
+        resource_group_map = {
+            "institution": resource_institution,
+            "institution_id": resource_institution_id,
+            "osg_id": resource_institution_osg_id,
+        }
         resources = resource_group.find("Resources")
         for resource in resources:
-            resource_map = {}
-            resource_map["institution"] = resource_institution
-            resource_map["institution_id"] = resource_institution_id
-            resource_map["osg_id"] = resource_institution_osg_id
-            resource_map["name"] = resource.find("Name").text
-            resource_map["id"] = resource.find("ID").text
-            resources_map[resource_map["name"].lower()] = resource_map.copy()
-
-    pickle.dump(resources_map, cache_file.open("wb"))
+            resource_map = {
+                **resource_group_map,
+                "name": resource.find("Name").text,
+                "id": resource.find("ID").text,
+            }
+            resources_map[resource_map["name"].lower()] = resource_map
+
+    dump_cache(cache_file, resources_map)
     return resources_map
 
 
+@lru_cache(maxsize=4)
 def get_prp_mapping_data(cache_file=Path("./prp_data_map.pickle")) -> dict:
-    if cache_file.exists() and cache_file.stat().st_mtime > time.time() - 23*3600:
-        try:
-            prp_id_map = pickle.load(cache_file.open("rb"))
-        except Exception:
-            pass
-        else:
-            return prp_id_map
+    cache, fresh = load_cache(cache_file, 23*3600)
+    if fresh:
+        return cache["data"]
 
     topology_resource_map = get_topology_resource_data()
     osg_id_institution_map = {d.get("osg_id"): d.get("institution") for d in topology_resource_map.values()}
     prp_id_map = {}
-    tries = 0
-    max_tries = 5
-    while tries < max_tries:
-        try:
-            with urlopen(INSTITUTION_IDS_DATA_URL) as f:
-                for resource in json.load(f):
-                    osg_id = resource.get("id")
-                    if not osg_id:
-                        continue
-                    institution = osg_id_institution_map.get(osg_id, resource.get("name"))
-                    if not institution:
-                        continue
-                    osg_id_short = osg_id.split("/")[-1]
-                    prp_id_map[osg_id_short] = institution
-                    # OSG_INSTITUTION_IDS mistakenly had the ROR IDs before ~2024-11-07,
-                    # so we map those too (as long as they don't conflict with OSG IDs)
-                    ror_id_short = (resource.get("ror_id") or "").split("/")[-1]
-                    if ror_id_short and ror_id_short not in prp_id_map:
-                        prp_id_map[ror_id_short] = institution
-        except HTTPError:
-            time.sleep(2**tries)
-            tries += 1
-            if tries == max_tries:
-                raise
-        else:
-            break
-
-    pickle.dump(prp_id_map, cache_file.open("wb"))
+    with urlopen_with_retry(INSTITUTION_IDS_DATA_URL) as f:
+        for resource in json_loads(f.read()):
+            osg_id = resource.get("id")
+            if not osg_id:
+                continue
+            institution = osg_id_institution_map.get(osg_id, resource.get("name"))
+            if not institution:
+                continue
+            osg_id_short = osg_id.split("/")[-1]
+            prp_id_map[osg_id_short] = institution
+            # OSG_INSTITUTION_IDS mistakenly had the ROR IDs before ~2024-11-07,
+            # so we map those too (as long as they don't conflict with OSG IDs)
+            ror_id_short = (resource.get("ror_id") or "").split("/")[-1]
+            if ror_id_short and ror_id_short not in prp_id_map:
+                prp_id_map[ror_id_short] = institution
+
+    dump_cache(cache_file, prp_id_map)
     return prp_id_map
 
 
+def prefetch_topology():
+    """Loads the Topology project and resource data concurrently,
+    later calls to the getters are served from their in-process caches"""
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(get_topology_project_data),
+            executor.submit(get_topology_resource_data),
+        ]
+    for future in futures:
+        future.result()
+
+
 def get_ospool_aps() -> set:
     current_ospool_aps = set()
     for collector_host in OSPOOL_COLLECTORS:
         try:
             collector = htcondor.Collector(collector_host)
-            aps = collector.query(htcondor.AdTypes.Schedd, projection=["Machine", "CollectorHost"])
+            aps = collector.query(
+                htcondor.AdTypes.Schedd,
+                constraint=OSPOOL_COLLECTORS_CONSTRAINT,
+                projection=["Machine"],
+            )
         except Exception:
             continue
         for ap in aps:
-            if set(re.split(r"[\s,]+", ap["CollectorHost"])) & OSPOOL_COLLECTORS:
-                current_ospool_aps.add(ap["Machine"])
+            current_ospool_aps.add(ap["Machine"])
     return current_ospool_aps | OSPOOL_APS
 
 
-def _smtp_mail(msg, recipient, smtp_server=None, smtp_username=None, smtp_password=None):
-    sent = False
-    result = None
+def _connect_smtp(smtp_server, smtp_username=None, smtp_password=None):
+    if smtp_username is None:
+        return smtplib.SMTP(smtp_server, timeout=SMTP_TIMEOUT)
+    smtp = smtplib.SMTP_SSL(smtp_server, timeout=SMTP_TIMEOUT)
+    smtp.login(smtp_username, smtp_password)
+    return smtp
+
+
+def _send_batch(smtp, body, from_addr, recipients, smtp_server) -> list:
+    """Sends to all recipients in one transaction, returns the recipients that were refused"""
+    try:
+        refused = smtp.sendmail(from_addr, recipients, body)
+    except smtplib.SMTPRecipientsRefused as err:
+        refused = err.recipients
+    except Exception as err:
+        print(f"Could not send to {', '.join(recipients)} using {smtp_server}", file=sys.stderr)
+        print(err, file=sys.stderr)
+        return list(recipients)
+    if len(refused) > 0:
+        print(f"Could not send email to some recipients using {smtp_server}:\n{refused}", file=sys.stderr)
+    return [recipient for recipient in recipients if recipient in refused]
+
+
+def _smtp_mail(body, from_addr, recipients, smtp_server=None, smtp_username=None, smtp_password=None) -> list:
+    """Sends the flattened message body to recipients in one transaction per try,
+    returns the recipients that were not sent to"""
+    pending = list(recipients)
     tries = 0
     sleeptime = 0
     while tries < 3 and sleeptime < 600:
         try:
-            if smtp_username is None:
-                smtp = smtplib.SMTP(smtp_server)
-            else:
-                smtp = smtplib.SMTP_SSL(smtp_server)
-                smtp.login(smtp_username, smtp_password)
+            smtp = _connect_smtp(smtp_server, smtp_username, smtp_password)
+        except (socket.gaierror, ConnectionRefusedError):
+            # Host does not resolve or is not listening, retrying will not help
+            print(f"Could not connect to {smtp_server}, not retrying", file=sys.stderr)
+            break
         except Exception:
             print(f"Could not connect to {smtp_server}", file=sys.stderr)
-            continue
-
-        try:
-            result = smtp.sendmail(msg["From"], recipient, msg.as_string())
-            if len(result) > 0:
-                print(f"Could not send email to {recipient} using {smtp_server}:\n{result}", file=sys.stderr)
-            else:
-                sent = True
-        except Exception:
-            print(f"Could not send to {recipient} using {smtp_server}", file=sys.stderr)
-            print(err, file=sys.stderr)
-        finally:
+        else:
             try:
-                smtp.quit()
-            except smtplib.SMTPServerDisconnected:
-                pass
-        if sent:
-            break
+                pending = _send_batch(smtp, body, from_addr, pending, smtp_server)
+            finally:
+                try:
+                    smtp.quit()
+                except smtplib.SMTPServerDisconnected:
+                    pass
+            if not pending:
+                break
 
         sleeptime = int(min(30 * 1.5**tries, 600))
         print(f"Sleeping for {sleeptime} seconds before retrying servers", file=sys.stderr)
@@ -267,7 +292,54 @@ def _smtp_mail(msg, recipient, smtp_server=None, smtp_username=None, smtp_passwo
     else:
         print(f"Failed to send email after {tries} loops", file=sys.stderr)
 
-    return sent
+    return pending
+
+
+def _mx_records(domain) -> tuple:
+    return tuple(str(mx).split()[1][:-1] for mx in DNS_RESOLVER.resolve(domain, "MX"))
+
+
+def _mx_deliver(body, from_addr, domain, recipients) -> bool:
+    pending = list(recipients)
+    for mxi, smtp_server in enumerate(_mx_records(domain)):
+        try:
+            pending = _smtp_mail(body, from_addr, pending, smtp_server)
+        except Exception:
+            continue
+        if not pending:
+            break
+
+        sleeptime = int(min(30 * 1.5**mxi, 600))
+        print(f"Sleeping for {sleeptime} seconds before trying next server for {domain}", file=sys.stderr)
+        time.sleep(sleeptime)
+
+    else:
+        print(f"Failed to send email to {', '.join(pending)} after trying all servers", file=sys.stderr)
+
+    return not pending
+
+
+def _attachment_part(fpath: Path) -> MIMEBase:
+    """Base64 encodes the file in chunks so its raw contents are never held in memory whole"""
+    part = MIMEBase("application", "octet-stream")
+    encoded = []
+    with fpath.open("rb") as f:
+        # Read multiples of 57 bytes, each 57 bytes encodes to one full 76 character line
+        for chunk in iter(lambda: f.read(57*1024), b""):
+            encoded.append(base64.encodebytes(chunk).decode("ascii"))
+    part.set_payload("".join(encoded))
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", "attachment", filename = fpath.name)
+    return part
+
+
+def _normalize_address(addr: str) -> str:
+    # Only the domain is case-insensitive, the local part has to be kept as given
+    addr = addr.strip()
+    local, at, domain = addr.rpartition("@")
+    if not at:
+        return addr
+    return f"{local}@{domain.lower()}"
 
 
 def send_email(
@@ -282,6 +354,7 @@ def send_email(
         smtp_server=None,
         smtp_username=None,
         smtp_password_file=None,
+        smtp_conn=None,
         **kwargs):
     if len(to_addrs) == 0:
         print("ERROR: No recipients in the To: field, not sending email", file=sys.stderr)
@@ -303,38 +376,29 @@ def send_email(
     msg.attach(MIMEText(html, "html"))
 
     for fname in attachments:
-        fpath = Path(fname)
-        part = MIMEBase("application", "octet-stream")
-        with fpath.open("rb") as f:
-            part.set_payload(f.read())
-        encoders.encode_base64(part)
-        part.add_header("Content-Disposition", "attachment", filename = fpath.name)
-        msg.attach(part)
-
-    if smtp_server is not None:
-        recipient = list(set(to_addrs + cc_addrs + bcc_addrs))
+        msg.attach(_attachment_part(Path(fname)))
+
+    # Serialize the message once, every connection and retry sends these bytes
+    body = msg.as_bytes()
+    recipients = sorted({addr for addr in map(_normalize_address, to_addrs + cc_addrs + bcc_addrs) if addr})
+    if not recipients:
+        print("ERROR: No valid recipient addresses, not sending email", file=sys.stderr)
+        return
+
+    if smtp_conn is not None:
+        # Caller manages this connection (e.g. to send several emails over it), so leave it open
+        _send_batch(smtp_conn, body, from_addr, recipients, "the provided SMTP connection")
+
+    elif smtp_server is not None:
         smtp_password = None
         if smtp_password_file is not None:
             smtp_password = smtp_password_file.open("r").read().strip()
-        _smtp_mail(msg, recipient, smtp_server, smtp_username, smtp_password)
+        _smtp_mail(body, from_addr, recipients, smtp_server, smtp_username, smtp_password)
 
     else:
-        for recipient in set(to_addrs + cc_addrs + bcc_addrs):
-            domain = recipient.split("@")[1]
-            sent = False
-            for mxi, mx in enumerate(dns_query(domain, "MX")):
-                smtp_server = str(mx).split()[1][:-1]
-
-                try:
-                    sent = _smtp_mail(msg, recipient, smtp_server)
-                except Exception:
-                    continue
-                if sent:
-                    break
-
-                sleeptime = int(min(30 * 1.5**mxi, 600))
-                print(f"Sleeping for {sleeptime} seconds before trying next server", file=sys.stderr)
-                time.sleep(sleeptime)
-
-            else:
-                print("Failed to send email after trying all servers", file=sys.stderr)
+        # Recipients on the same domain share MX servers, so send to them over one connection
+        domain_recipients = defaultdict(list)
+        for recipient in recipients:
+            domain_recipients[recipient.split("@")[1]].append(recipient)
+        with ThreadPoolExecutor(max_workers=min(32, len(domain_recipients))) as executor:
+            list(executor.map(lambda domain: _mx_deliver(body, from_addr, domain, domain_recipients[domain]), domain_recipients))
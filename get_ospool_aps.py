@@ -8,15 +8,20 @@ OSPOOL_COLLECTORS = {
     "flock.opensciencegrid.org",
 }
 
+# st_mtime_ns and AP set from the last time the host map file was read
+_loaded_aps = {"mtime_ns": None, "aps": set()}
+
 def get_ospool_aps():
-    aps = set()
-    ap_collector_host_map = pickle.load(open(OSPOOL_AP_COLLECTOR_HOST_MAP_FILE, "rb"))
-    for ap, collectors in ap_collector_host_map.items():
-        if ap.startswith("jupyter-notebook-") or ap.startswith("jupyterlab-"):
-            continue
-        if len(collectors & OSPOOL_COLLECTORS) > 0:
-            aps.add(ap)
-    return aps
+    mtime_ns = OSPOOL_AP_COLLECTOR_HOST_MAP_FILE.stat().st_mtime_ns
+    if _loaded_aps["mtime_ns"] != mtime_ns:
+        with OSPOOL_AP_COLLECTOR_HOST_MAP_FILE.open("rb") as f:
+            ap_collector_host_map = pickle.load(f)
+        _loaded_aps["aps"] = {
+            ap for ap, collectors in ap_collector_host_map.items()
+            if not ap.startswith(("jupyter-notebook-", "jupyterlab-")) and collectors & OSPOOL_COLLECTORS
+        }
+        _loaded_aps["mtime_ns"] = mtime_ns
+    return set(_loaded_aps["aps"])
 
 
 if __name__ == "__main__":
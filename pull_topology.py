@@ -1,15 +1,18 @@
 import pickle
+import pickletools
 import tempfile
 import os
 import time
-import xml.etree.ElementTree as ET
-from urllib.request import urlopen
 from pathlib import Path
 
+from topology_cache import iter_resource_groups
+
 
-RESOURCE_SUMMARY_URL = "https://topology.opensciencegrid.org/rgsummary/xml"
 TOPOLOGY_PICKLE = Path("topology_map.pkl")
 
+# topology_pickle -> (st_mtime_ns, mappings) of the last load
+_loaded_mappings = {}
+
 
 MANUAL_FACILITY_MAPPINGS = {
     "SURFsara": "SURFsara",  # European
@@ -47,31 +50,28 @@ MANUAL_GROUP_MAPPINGS = {
 def get_latest_mappings():
     """Gets latest mappings from topology XML"""
 
-    xmltree = ET.parse(urlopen(RESOURCE_SUMMARY_URL))
-    xmlroot = xmltree.getroot()
-
     mappings = {
         "group": MANUAL_GROUP_MAPPINGS.copy(),
         "facility": MANUAL_FACILITY_MAPPINGS.copy(),
         "site": MANUAL_SITE_MAPPINGS.copy(),
     }
 
-    for resource_group in xmlroot:
-        names = {
-            "group": resource_group.find("GroupName").text,
-            "facility": resource_group.find("Facility").find("Name").text,
-            "site": resource_group.find("Site").find("Name").text,
-        }
+    group_map = mappings["group"]
+    facility_map = mappings["facility"]
+    site_map = mappings["site"]
 
-        for name in names.values():
-            for mapping_type in mappings.keys():
-                mappings[mapping_type][name] = names[mapping_type]
+    for resource_group in iter_resource_groups():
+        group = resource_group.findtext("GroupName")
+        facility = resource_group.find("Facility").findtext("Name")
+        site = resource_group.find("Site").findtext("Name")
 
-        resources = resource_group.find("Resources")
-        for resource in resources:
-            resource_name = resource.find("Name").text
-            for mapping_type in mappings.keys():
-                mappings[mapping_type][resource_name] = names[mapping_type]
+        # The group, facility, site, and each resource name all map to this group's names
+        names = [group, facility, site]
+        names.extend(resource.findtext("Name") for resource in resource_group.find("Resources"))
+        for name in names:
+            group_map[name] = group
+            facility_map[name] = facility
+            site_map[name] = site
 
     return mappings
 
@@ -81,14 +81,23 @@ def update_topology_pickle(topology_pickle):
 
     mappings = get_latest_mappings()
 
-    # Write atomically
+    # Write atomically, no fsync since the file can always be regenerated from topology
     with tempfile.NamedTemporaryFile(delete=False, dir=str(Path.cwd())) as tf:
-        tmpfile = Path(tf.name)
-        with tmpfile.open("wb") as f:
-            pickle.dump(mappings, f, pickle.HIGHEST_PROTOCOL)
-            f.flush()
-            os.fsync(f.fileno())
-    tmpfile.rename(topology_pickle)
+        tf.write(pickletools.optimize(pickle.dumps(mappings, pickle.HIGHEST_PROTOCOL)))
+    os.replace(tf.name, topology_pickle)
+
+
+def load_topology_pickle(topology_pickle):
+    """Returns mappings from the pickle file, reusing the last load if the file is unchanged"""
+
+    mtime_ns = topology_pickle.stat().st_mtime_ns
+    cached = _loaded_mappings.get(topology_pickle)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+    with topology_pickle.open("rb") as f:
+        mappings = pickle.load(f)
+    _loaded_mappings[topology_pickle] = (mtime_ns, mappings)
+    return mappings
 
 
 def get_mappings(topology_pickle=TOPOLOGY_PICKLE, force_update=False):
@@ -98,10 +107,9 @@ def get_mappings(topology_pickle=TOPOLOGY_PICKLE, force_update=False):
     try:
         if (time.time() - topology_pickle.stat().st_mtime > 23*3600) or force_update:
             update_topology_pickle(topology_pickle)
-        return pickle.load(topology_pickle.open("rb"))
     except FileNotFoundError:
         update_topology_pickle(topology_pickle)
-    return pickle.load(topology_pickle.open("rb"))
+    return load_topology_pickle(topology_pickle)
 
 
 if __name__ == "__main__":
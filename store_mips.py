@@ -1,8 +1,10 @@
 import htcondor
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, Counter
 from operator import itemgetter
+import heapq
 import elasticsearch
+import elasticsearch.helpers
 import json
 
 from pull_topology import get_mappings
@@ -12,13 +14,39 @@ pool_name = "OSPool"
 mips_threshold = 11800
 
 es_index_name = "mips_report"
+es_index_body = json.dumps({
+    "mappings": {
+        "dynamic_templates": [
+            {
+                "strings_as_keywords": {
+                    "match_mapping_type": "string",
+                    "mapping": {"type": "keyword", "norms": "false", "ignore_above": 256},
+                }
+            },
+        ],
+        "properties": {
+            "date": {"type": "date", "format": "yyyy-MM-dd HH:mm:ss"},
+        },
+        "date_detection": False,
+        "numeric_detection": True,
+    }
+})
+_es_client = None
+_es_index_checked = False
 
 now = datetime.now()
+now_str = now.strftime("%Y-%m-%d %H:%M:%S")
 
-def get_mips():
+def get_mips(pool):
     mappings = get_mappings()
+    site_map = mappings["site"]
+    facility_map = mappings["facility"]
     collector = htcondor.Collector(pool)
-    startd_ads = collector.query(htcondor.AdTypes.Startd, projection=["GLIDEIN_ResourceName", "Mips", "Cpus", "Has_Singularity"])
+    startd_ads = collector.query(
+        htcondor.AdTypes.Startd,
+        constraint="Mips =!= undefined && Cpus =!= undefined",
+        projection=["GLIDEIN_ResourceName", "Mips", "Cpus", "Has_Singularity"]
+    )
 
     resource_cores = defaultdict(int)
     site_cores = defaultdict(int)
@@ -26,93 +54,104 @@ def get_mips():
     non_singularity_resources = set()
     non_singularity_sites = set()
     non_singularity_facilities = set()
-    mips = []
-    has_singularity = []
+    # Cores per distinct MIPS value, there are far fewer distinct values than slots
+    mips_cores = Counter()
+    singularity_cores = 0
+    # Many slots share a resource, so look up each resource's site and facility once
+    resource_names = {}
     for ad in startd_ads:
-        if not ("Mips" in ad) or not ("Cpus" in ad):
-            continue
         try:
-            resource = ad["GLIDEIN_ResourceName"]
-            site = mappings["site"].get(resource, f"Unmapped resource {resource}")
-            facility = mappings["facility"].get(resource, f"Unmapped resource {resource}")
-
-            int(ad["Mips"])
+            m = int(ad["Mips"])
             cores = int(ad["Cpus"])
-
-            if cores > 0:
-                resource_cores[resource] += cores
-                site_cores[site] += cores
-                facility_cores[facility] += cores
-
-            if not ad.get("Has_Singularity", False):
-                non_singularity_resources.add(resource)
-                non_singularity_sites.add(site)
-                non_singularity_facilities.add(facility)
-
-        except ValueError:
+        except (ValueError, KeyError):
             continue
 
-        for i in range(cores):
-            try:
-                has_singularity.append(int(ad.get("Has_Singularity", False) == True))
-            except Exception:
-                pass
-            mips.append(ad["Mips"])
-
-    return mips, resource_cores, site_cores, facility_cores, non_singularity_resources, non_singularity_sites, non_singularity_facilities, has_singularity
-
-
-def get_mips_summary(mips, resource_cores, site_cores, facility_cores, non_singularity_resources, non_singularity_sites, non_singularity_facilities, has_singularity):
-    mips.sort()
-
+        resource = ad["GLIDEIN_ResourceName"]
+        names = resource_names.get(resource)
+        if names is None:
+            names = resource_names[resource] = (
+                site_map.get(resource, f"Unmapped resource {resource}"),
+                facility_map.get(resource, f"Unmapped resource {resource}"),
+            )
+        site, facility = names
+
+        has_singularity = bool(ad.get("Has_Singularity", False))
+        if not has_singularity:
+            non_singularity_resources.add(resource)
+            non_singularity_sites.add(site)
+            non_singularity_facilities.add(facility)
+
+        if cores > 0:
+            resource_cores[resource] += cores
+            site_cores[site] += cores
+            facility_cores[facility] += cores
+            mips_cores[m] += cores
+            if has_singularity:
+                singularity_cores += cores
+
+    return mips_cores, resource_cores, site_cores, facility_cores, non_singularity_resources, non_singularity_sites, non_singularity_facilities, singularity_cores
+
+
+def get_mips_summary(pool, pool_name, mips_cores, resource_cores, site_cores, facility_cores, non_singularity_resources, non_singularity_sites, non_singularity_facilities, singularity_cores):
+    mips_values = sorted(mips_cores.items())
+    total_cores = sum(mips_cores.values())
+
+    # Gather every total in one walk over the distinct MIPS values,
+    # the median is the value that the running core count first passes half of the total
+    total_mips = 0
+    slow_cores = 0
     total_slow_mips = 0
-    for slow_mips_i, m in enumerate(mips):
-        if m >= mips_threshold:
-            break
-
-    total_slow_mips = sum(mips[:slow_mips_i])
-    total_mips = sum(mips)
-    total_has_singularity = sum(has_singularity)
-
-    resources_by_core_count = [k for k, v in sorted(resource_cores.items(), key=itemgetter(1), reverse=True)]
-    facilities_by_core_count = [k for k, v in sorted(facility_cores.items(), key=itemgetter(1), reverse=True)]
-    sites_by_core_count = [k for k, v in sorted(site_cores.items(), key=itemgetter(1), reverse=True)]
+    cores_so_far = 0
+    median_mips = None
+    for m, c in mips_values:
+        value_mips = m*c
+        if m < mips_threshold:
+            slow_cores += c
+            total_slow_mips += value_mips
+        total_mips += value_mips
+        cores_so_far += c
+        if median_mips is None and cores_so_far > total_cores//2:
+            median_mips = m
+
+    top_core_resources = [k for k, v in heapq.nlargest(3, resource_cores.items(), key=itemgetter(1))]
+    top_core_facilities = [k for k, v in heapq.nlargest(3, facility_cores.items(), key=itemgetter(1))]
+    top_core_sites = [k for k, v in heapq.nlargest(3, site_cores.items(), key=itemgetter(1))]
 
     mips_summary = {
-        "date": now.strftime("%Y-%m-%d %H:%M:%S"),
+        "date": now_str,
         "pool": pool,
         "pool_name": pool_name,
         "mips_threshold": mips_threshold,
         "total_facilities": len(facility_cores),
         "total_sites": len(site_cores),
         "total_resources": len(resource_cores),
-        "top_3_core_resources": ",".join(resources_by_core_count[:3]),
-        "top_3_core_facilities": ",".join(facilities_by_core_count[:3]),
-        "top_3_core_sites": ",".join(sites_by_core_count[:3]),
+        "top_3_core_resources": ",".join(top_core_resources),
+        "top_3_core_facilities": ",".join(top_core_facilities),
+        "top_3_core_sites": ",".join(top_core_sites),
         "total_non_singularity_resources": len(non_singularity_resources),
         "total_non_singularity_sites": len(non_singularity_sites),
         "total_non_singularity_facilities": len(non_singularity_facilities),
         "non_singularity_resources": ",".join(sorted(list(non_singularity_resources))),
-        "min_mips": mips[0],
-        "max_mips": mips[-1],
-        "mean_mips": int(total_mips/len(mips)),
-        "median_mips": mips[len(mips)//2],
-        "total_cores": len(mips),
-        "slow_cores": slow_mips_i,
+        "min_mips": mips_values[0][0] if mips_values else 0,
+        "max_mips": mips_values[-1][0] if mips_values else 0,
+        "mean_mips": int(total_mips/total_cores) if total_cores else 0,
+        "median_mips": median_mips if median_mips is not None else 0,
+        "total_cores": total_cores,
+        "slow_cores": slow_cores,
         "total_slow_mips": total_slow_mips,
         "total_mips": total_mips,
-        "pct_slow_mips": 100*total_slow_mips/total_mips,
-        "total_singularity_cores": total_has_singularity,
-        "pct_singularity_cores": 100*total_has_singularity/len(has_singularity),
+        "pct_slow_mips": 100*total_slow_mips/total_mips if total_mips else 0.0,
+        "total_singularity_cores": singularity_cores,
+        "pct_singularity_cores": 100*singularity_cores/total_cores if total_cores else 0.0,
     }
     return mips_summary
 
 
-def get_expanse():
+def get_expanse(pool):
     collector = htcondor.Collector(pool)
     expanse_ads = collector.query(
         htcondor.AdTypes.Startd,
-        constraint='GLIDEIN_ResourceName == "Expanse-PATH-EP" && PartitionableSlot',
+        constraint='GLIDEIN_ResourceName == "Expanse-PATH-EP" && PartitionableSlot && Cpus =!= undefined && Memory =!= undefined && Disk =!= undefined',
         projection=["Cpus", "Memory", "Disk"]
     )
 
@@ -120,10 +159,16 @@ def get_expanse():
     # "Completely exhausted" EP has less than 1 core, 1GB RAM, or 5GB Disk unclaimed
 
     total_expanse_eps = len(expanse_ads)
-    cpus_exhausted = sum(ad["Cpus"] < 1 for ad in expanse_ads)
-    disk_exhausted = sum(ad['Disk'] < (5*1024*1024) for ad in expanse_ads)
-    mem_almost_exhausted = sum(ad['Memory'] < (2*1024) for ad in expanse_ads)
-    mem_completely_exhausted = sum(ad['Memory'] < (1*1024) for ad in expanse_ads)
+    cpus_exhausted = 0
+    disk_exhausted = 0
+    mem_almost_exhausted = 0
+    mem_completely_exhausted = 0
+    for ad in expanse_ads:
+        memory = ad["Memory"]
+        cpus_exhausted += ad["Cpus"] < 1
+        disk_exhausted += ad["Disk"] < (5*1024*1024)
+        mem_almost_exhausted += memory < (2*1024)
+        mem_completely_exhausted += memory < (1*1024)
     almost_exhausted_expanse_eps = max([cpus_exhausted, disk_exhausted, mem_almost_exhausted])
     completely_exhausted_expanse_eps = max([cpus_exhausted, disk_exhausted, mem_completely_exhausted])
 
@@ -131,6 +176,8 @@ def get_expanse():
 
 
 def get_expanse_summary(total_expanse_eps, cpus_exhausted, disk_exhausted, mem_almost_exhausted, mem_completely_exhausted, almost_exhausted_expanse_eps, completely_exhausted_expanse_eps):
+    # Every percentage is out of the same EP count, and Expanse may have no EPs up at all
+    pct_per_ep = 100/total_expanse_eps if total_expanse_eps else 0.0
     expanse_summary = {
         "total_expanse_eps": total_expanse_eps,
         "cpus_exhausted": cpus_exhausted,
@@ -140,52 +187,72 @@ def get_expanse_summary(total_expanse_eps, cpus_exhausted, disk_exhausted, mem_a
         "almost_exhausted_expanse_eps": almost_exhausted_expanse_eps,
         "completely_exhausted_expanse_eps": completely_exhausted_expanse_eps,
 
-        "pct_expanse_exhausted": 100 * completely_exhausted_expanse_eps / total_expanse_eps,
-        "pct_expanse_almost_exhausted": 100 * almost_exhausted_expanse_eps / total_expanse_eps,
-        "pct_expanse_cpus_exhausted": 100 * cpus_exhausted / total_expanse_eps,
-        "pct_expanse_mem_exhausted": 100 * mem_completely_exhausted / total_expanse_eps,
-        "pct_expanse_mem_almost_exhausted": 100 * mem_almost_exhausted / total_expanse_eps,
-        "pct_expanse_disk_exhausted": 100 * disk_exhausted / total_expanse_eps,
+        "pct_expanse_exhausted": pct_per_ep * completely_exhausted_expanse_eps,
+        "pct_expanse_almost_exhausted": pct_per_ep * almost_exhausted_expanse_eps,
+        "pct_expanse_cpus_exhausted": pct_per_ep * cpus_exhausted,
+        "pct_expanse_mem_exhausted": pct_per_ep * mem_completely_exhausted,
+        "pct_expanse_mem_almost_exhausted": pct_per_ep * mem_almost_exhausted,
+        "pct_expanse_disk_exhausted": pct_per_ep * disk_exhausted,
     }
     return expanse_summary
 
 
-def push_mips_summary(mips_summary):
-    es = elasticsearch.Elasticsearch()
-    #index_client = elasticsearch.client.IndicesClient(es)
+def get_es_client():
+    """Returns the process-wide Elasticsearch client, creating it on first use"""
+    global _es_client
+    if _es_client is None:
+        _es_client = elasticsearch.Elasticsearch(maxsize=4, retry_on_timeout=True)
+    return _es_client
+
+
+def _ensure_index(es):
+    """Creates the MIPS report index if needed, checking only once per process"""
+    global _es_index_checked
+    if _es_index_checked:
+        return
     if not es.indices.exists(es_index_name):
-        properties = {
-            "date": {"type": "date", "format": "yyyy-MM-dd HH:mm:ss"},
-        }
-        dynamic_templates = [
-            {
-                "strings_as_keywords": {
-                    "match_mapping_type": "string",
-                    "mapping": {"type": "keyword", "norms": "false", "ignore_above": 256},
-                }
-            },
-        ]
-        mappings = {
-            "dynamic_templates": dynamic_templates,
-            "properties": properties,
-            "date_detection": False,
-            "numeric_detection": True,
+        es.indices.create(index=es_index_name, body=es_index_body)
+    _es_index_checked = True
+
+
+def push_mips_summaries(mips_summaries):
+    """Indexes any number of summaries in bulk requests instead of one request each"""
+    es = get_es_client()
+    #index_client = elasticsearch.client.IndicesClient(es)
+    _ensure_index(es)
+    actions = (
+        {
+            "_index": es_index_name,
+            "_id": f"{mips_summary['pool']}_{mips_summary['date']}",
+            "_source": mips_summary,
         }
-        body = json.dumps({"mappings": mappings})
-        es.indices.create(index=es_index_name, body=body)
-    doc_id = f"{mips_summary['pool']}_{mips_summary['date']}"
-    es.index(index=es_index_name, id=doc_id, body=mips_summary)
+        for mips_summary in mips_summaries
+    )
+    elasticsearch.helpers.bulk(es, actions, chunk_size=500)
 
-def main():
 
-    data_objs = get_mips()
-    mips_summary = get_mips_summary(*data_objs)
+def push_mips_summary(mips_summary):
+    push_mips_summaries([mips_summary])
+
+def report(pool, pool_name):
+    """Returns the combined MIPS and Expanse summary for one pool"""
+
+    data_objs = get_mips(pool)
+    mips_summary = get_mips_summary(pool, pool_name, *data_objs)
 
-    expanse_objs = get_expanse()
+    expanse_objs = get_expanse(pool)
     expanse_summary = get_expanse_summary(*expanse_objs)
 
     total_summary = mips_summary.copy()
     total_summary.update(expanse_summary)
+    return total_summary
+
+
+def main():
+
+    _ensure_index(get_es_client())
+
+    total_summary = report(pool, pool_name)
 
     push_mips_summary(total_summary)
     #print(total_summary)
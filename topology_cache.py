@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import pickle
+import pickletools
+import tempfile
+from io import BytesIO
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+from pathlib import Path
+
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+
+RESOURCE_SUMMARY_URL = "https://topology.opensciencegrid.org/rgsummary/xml"
+RESOURCE_SUMMARY_CACHE = Path("./topology_rgsummary_xml.pickle")
+
+HTTP_TIMEOUT = 30
+HTTP_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+HTTP_MAX_RETRY_AFTER = 60
+
+# os.umask() can only be read by setting it, so do that once here rather than
+# from the cache writers, which may run in threads
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _cache_load(cache_file: Path) -> dict:
+    cache = pickle.loads(cache_file.read_bytes())
+    if cache.keys() != {"data", "validators"}:
+        raise ValueError(f"Unrecognized cache format in {cache_file}")
+    return cache
+
+
+def load_cache(cache_file: Path, max_age: float):
+    """Returns (cache, is_fresh), cache is None if missing or unreadable"""
+    try:
+        mtime = cache_file.stat().st_mtime
+        cache = _cache_load(cache_file)
+    except Exception:
+        return None, False
+    return cache, mtime > time.time() - max_age
+
+
+def dump_cache(cache_file: Path, data, validators=None):
+    # Write atomically through a unique temp file, so an interrupted write never leaves
+    # a truncated cache behind and concurrent writers never share a temp file
+    cache = {"data": data, "validators": validators or {}}
+    tf = tempfile.NamedTemporaryFile(delete=False, dir=str(cache_file.parent))
+    try:
+        with tf:
+            tf.write(pickletools.optimize(pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL)))
+        # NamedTemporaryFile is owner-only, give the cache the usual umask permissions
+        os.chmod(tf.name, 0o666 & ~_UMASK)
+        os.replace(tf.name, cache_file)
+    except BaseException:
+        os.unlink(tf.name)
+        raise
+
+
+def _conditional_request(url, validators: dict) -> Request:
+    request = Request(url)
+    if validators.get("etag"):
+        request.add_header("If-None-Match", validators["etag"])
+    if validators.get("last_modified"):
+        request.add_header("If-Modified-Since", validators["last_modified"])
+    return request
+
+
+def urlopen_with_retry(url, validators=None, max_tries=5):
+    """Opens url, retrying connection failures and transient HTTP errors with backoff"""
+    request = _conditional_request(url, validators or {})
+    tries = 0
+    while True:
+        try:
+            return urlopen(request, timeout=HTTP_TIMEOUT)
+        except HTTPError as err:
+            tries += 1
+            if err.code not in HTTP_RETRY_STATUS_CODES or tries == max_tries:
+                raise
+            retry_after = err.headers.get("Retry-After", "")
+            # Don't let the server stall the report for hours between tries
+            sleeptime = min(int(retry_after), HTTP_MAX_RETRY_AFTER) if retry_after.isdigit() else 2**(tries-1)
+        except (URLError, TimeoutError):
+            tries += 1
+            if tries == max_tries:
+                raise
+            sleeptime = 2**(tries-1)
+        time.sleep(sleeptime)
+
+
+def response_validators(response) -> dict:
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def fetch_rgsummary_xml(cache_file=RESOURCE_SUMMARY_CACHE, max_age=3600) -> bytes:
+    """Returns the Topology resource summary XML, shared by every reader in the job"""
+
+    cache, fresh = load_cache(cache_file, max_age)
+    if fresh:
+        return cache["data"]
+    validators = cache["validators"] if cache is not None else {}
+    try:
+        with urlopen_with_retry(RESOURCE_SUMMARY_URL, validators) as response:
+            validators = response_validators(response)
+            xml = response.read()
+    except HTTPError as err:
+        if err.code == 304 and cache is not None:
+            try:
+                cache_file.touch()
+            except OSError as touch_err:
+                print(f"Could not refresh {cache_file}: {touch_err}", file=sys.stderr)
+            return cache["data"]
+        raise
+
+    # Several cron jobs share this cache, failing to update it shouldn't fail the report
+    try:
+        dump_cache(cache_file, xml, validators)
+    except OSError as dump_err:
+        print(f"Could not write {cache_file}: {dump_err}", file=sys.stderr)
+    return xml
+
+
+def iter_resource_groups():
+    """Yields each <ResourceGroup> of the resource summary, freeing it once the caller moves on"""
+
+    for _, resource_group in ET.iterparse(BytesIO(fetch_rgsummary_xml()), events=("end",)):
+        if resource_group.tag != "ResourceGroup":
+            continue
+        yield resource_group
+        resource_group.clear()